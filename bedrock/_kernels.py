@@ -0,0 +1,48 @@
+# Bit packing of subchunk block ids. Compiled with numba if it is installed, plain numpy otherwise.
+
+import numpy as np
+
+try:
+  from numba import njit
+except ImportError:
+  njit = None
+
+# Ids are stored as a number of bitsPerBlock sized fields per 32 bit word, lowest bits first.
+#  A word never holds part of an id, so some high bits may be left unused.
+
+def _unpackBlocksNumpy(words, bitsPerBlock, count):
+  blocksPerWord = 32 // bitsPerBlock
+  # Shift every word by each block's offset at once, then mask out number of bits for one block.
+  shifts = np.arange(blocksPerWord, dtype=np.uint32) * bitsPerBlock
+  mask = np.uint32((1 << bitsPerBlock) - 1)
+  return ((words.reshape(-1, 1) >> shifts) & mask).reshape(-1)[:count] # Trim padding at end.
+
+def _packBlocksNumpy(blockIDs, bitsPerBlock, numWords):
+  blocksPerWord = 32 // bitsPerBlock
+  padded = np.zeros(numWords * blocksPerWord, dtype=np.uint32) # Zero padding at end.
+  padded[:len(blockIDs)] = blockIDs
+  shifts = np.arange(blocksPerWord, dtype=np.uint32) * bitsPerBlock
+  return np.bitwise_or.reduce(padded.reshape(numWords, blocksPerWord) << shifts, axis=1)
+
+# Plain loops, which numba compiles to better code than the broadcasting above.
+def _unpackBlocksLoop(words, bitsPerBlock, count):
+  blocksPerWord = 32 // bitsPerBlock
+  mask = (1 << bitsPerBlock) - 1
+  blocks = np.empty(count, dtype=np.uint32)
+  for i in range(count):
+    blocks[i] = (words[i // blocksPerWord] >> ((i % blocksPerWord) * bitsPerBlock)) & mask
+  return blocks
+
+def _packBlocksLoop(blockIDs, bitsPerBlock, numWords):
+  blocksPerWord = 32 // bitsPerBlock
+  words = np.zeros(numWords, dtype=np.uint32)
+  for i in range(len(blockIDs)):
+    words[i // blocksPerWord] |= blockIDs[i] << ((i % blocksPerWord) * bitsPerBlock)
+  return words
+
+if njit is None:
+  unpackBlocks = _unpackBlocksNumpy
+  packBlocks = _packBlocksNumpy
+else:
+  unpackBlocks = njit(cache=True)(_unpackBlocksLoop)
+  packBlocks = njit(cache=True)(_packBlocksLoop)
@@ -5,6 +5,7 @@ import os.path
 import numpy as np
 from . import leveldb as ldb
 from . import nbt
+from . import _kernels
 
 # Handles chunk loading and mapping blocks to chunks.
 class World:
@@ -47,6 +48,18 @@ class World:
     chunk = self.getChunk(cx, cz, dimension)
     return chunk.setBlock(x, y, z, block, layer)
 
+  # Set a box of blocks with its lowest corner at x y z. blocks is a 3D array (or nested lists) of Block indexed [x, y, z].
+  def setBlocks(self, x, y, z, blocks, layer=0, dimension=0):
+    blocks = np.asarray(blocks, dtype=Block)
+    sizeX, _, sizeZ = blocks.shape
+    # Hand each chunk the part of the box inside it.
+    for cx in range(x // 16, (x + sizeX - 1) // 16 + 1):
+      startX, endX = max(x, cx * 16), min(x + sizeX, cx * 16 + 16)
+      for cz in range(z // 16, (z + sizeZ - 1) // 16 + 1):
+        startZ, endZ = max(z, cz * 16), min(z + sizeZ, cz * 16 + 16)
+        chunk = self.getChunk(cx, cz, dimension)
+        chunk.setBlocks(startX % 16, y, startZ % 16, blocks[startX - x:endX - x, :, startZ - z:endZ - z], layer)
+
   def save(self):
     for chunk in self.chunks.values():
       chunk.save(self.db)
@@ -94,69 +107,78 @@ class Chunk:
         self.keyBase = struct.pack("<ii", self.x, self.z)
     else:
         self.keyBase = struct.pack("<iii", self.x, self.z, self.dimension)
+    self._stored = {} # Key suffix to the data last read from or written to the db, see _put.
+
+    # Each key is keyBase followed by a tag byte (and the y level for subchunks). Read them all with one seek
+    #  instead of a lookup each. The tags we use run from `,` to `v`, which also leaves out other dimensions'
+    #  chunks whose keyBase starts with this one.
+    records = {}
+    for key, value in ldb.iterate(db, self.keyBase + b",", self.keyBase + b"w"):
+      records[key[len(self.keyBase):]] = value
 
-    self.version = self._loadVersion(db)
+    self.version = self._loadVersion(records)
     self.cavesAndCliffs = self.version >= 25
     if not self.cavesAndCliffs:
-      self.hMap, self.biomes = self._load2D(db)
+      self.hMap, self.biomes = self._load2D(records)
     else:
       self.hMap, self.biomes = None, None
 
     self.subchunks = []
     for i in range(24 if self.cavesAndCliffs else 16):
-      try:
-        self.subchunks.append(SubChunk(db, self.x, self.z, i, self.dimension)) #Pass off processing to the subchunk class
+      data = records.get(b"/" + bytes((i,)))
       #Supposedly if a subchunk exists then all the subchunks below it exist. This is not the case.
-      except NotFoundError:
+      if data is None:
         self.subchunks.append(None)
+      else:
+        self.subchunks.append(SubChunk(db, self.x, self.z, i, self.dimension, self.keyBase, data)) #Pass off processing to the subchunk class
 
-    self._loadTileEntities(db)
-    self.entities = self._loadEntities(db)
+    self._tileEntityData = records.get(b"1") # Applied to blocks on first use, see _loadTileEntities.
+    self._tileEntityLayout = {} # Position to load order and where x y z were, see _saveTileEntities.
+    if self._tileEntityData is not None:
+      self._stored[b"1"] = self._tileEntityData
+    self.entities = self._loadEntities(records)
 
   # Version is simply a stored value.
-  def _loadVersion(self, db):
-    try:
-      try:
-        version = ldb.get(db, self.keyBase + b",")
-      except KeyError:
-        version = ldb.get(db, self.keyBase + b"v")
-      version = struct.unpack("<B", version)[0]
-      if version not in [10, 13, 14, 15, 18, 19, 21, 22, 25]:
-        raise NotImplementedError("Unexpected chunk version {} at chunk {} {} (Dim {}).".format(version, self.x, self.z, self.dimension))
-    except KeyError:
+  def _loadVersion(self, records):
+    if b"," in records:
+      version = self._stored[b","] = records[b","]
+    elif b"v" in records:
+      version = records[b"v"]
+    else:
       raise KeyError("Chunk at {}, {} (Dim {}) does not exist.".format(self.x, self.z, self.dimension))
+    version = struct.unpack("<B", version)[0]
+    if version not in [10, 13, 14, 15, 18, 19, 21, 22, 25]:
+      raise NotImplementedError("Unexpected chunk version {} at chunk {} {} (Dim {}).".format(version, self.x, self.z, self.dimension))
     return version
 
   # Load heightmap (seemingly useless) and biome info
-  def _load2D(self, db):
-    data = ldb.get(db, self.keyBase + b'-')
-    heightMap = struct.unpack("<" + "H" * 16 * 16, data[:2 * 16 * 16])
-    biomes = struct.unpack("B" * 16 * 16, data[2 * 16 * 16:])
+  def _load2D(self, records):
+    data = self._stored[b"-"] = records[b"-"]
+    # Copied out of the db buffer so they can be edited.
+    heightMap = np.frombuffer(data, dtype="<u2", count=16 * 16).copy()
+    biomes = np.frombuffer(data, dtype=np.uint8, count=16 * 16, offset=2 * 16 * 16).copy()
     return heightMap, biomes
 
   # Tile entities are stored as a bunch of NBT compound tags end to end.
-  def _loadTileEntities(self, db):
-    try:
-      data = ldb.get(db, self.keyBase + b"1")
-    except KeyError:
-      return
-    data = nbt.DataReader(data)
+  def _loadTileEntities(self):
+    data, self._tileEntityData = nbt.DataReader(self._tileEntityData), None
     while not data.finished():
       nbtData = nbt.decode(data)
+      layout = [(j, tag.name) for j, tag in enumerate(nbtData.payload) if tag.name in ("x", "y", "z")]
       x = nbtData.pop("x").payload # We add back theses with the correct value on save, they are important.
       y = nbtData.pop("y").payload
       z = nbtData.pop("z").payload
-      block = self.getBlock(x % 16, y, z % 16)
-      if not block:
+      self._tileEntityLayout[(x, y, z)] = (len(self._tileEntityLayout), layout)
+      i = (y + 64 if self.cavesAndCliffs else y) // 16
+      if not 0 <= i < len(self.subchunks) or self.subchunks[i] is None:
         print("Warning: Cannot apply nbt to block at {} {} {} since it does not exist.".format(x, y, z))
         continue
-      block.nbt = nbtData
+      self.subchunks[i].nbt[(0, x % 16, y % 16, z % 16)] = nbtData
 
-  def _loadEntities(self, db):
-    try:
-      data = ldb.get(db, self.keyBase + b"2")
-    except KeyError:
+  def _loadEntities(self, records):
+    if b"2" not in records:
       return []
+    data = self._stored[b"2"] = records[b"2"]
     data = nbt.DataReader(data)
     entities = []
     while not data.finished():
@@ -164,6 +186,8 @@ class Chunk:
     return entities
 
   def getBlock(self, x, y, z, layer=0):
+    if self._tileEntityData is not None:
+      self._loadTileEntities()
     if self.cavesAndCliffs:
       y += 64
     if y // 16 + 1 > len(self.subchunks) or self.subchunks[y // 16] is None:
@@ -171,107 +195,150 @@ class Chunk:
     return self.subchunks[y // 16].getBlock(x, y % 16, z, layer)
 
   def setBlock(self, x, y, z, block, layer=0):
+    if self._tileEntityData is not None:
+      self._loadTileEntities()
     if self.cavesAndCliffs:
       y += 64
-    while y // 16 + 1 > len(self.subchunks):
-      self.subchunks.append(SubChunk.empty(self.x, self.z, len(self.subchunks), self.dimension))
-    if self.subchunks[y // 16] is None:
-      self.subchunks[y // 16] = SubChunk.empty(self.x, self.z, y // 16, self.dimension)
-    self.subchunks[y // 16].setBlock(x, y % 16, z, block, layer)
+    self._makeSubChunk(y // 16).setBlock(x, y % 16, z, block, layer)
 
+  # Set a box of blocks with its lowest corner at x y z, see World.setBlocks.
+  def setBlocks(self, x, y, z, blocks, layer=0):
+    if self._tileEntityData is not None:
+      self._loadTileEntities()
+    if self.cavesAndCliffs:
+      y += 64
+    bottom = y
+    top = y + blocks.shape[1]
+    while y < top: # One subchunk at a time.
+      end = min(top, (y // 16 + 1) * 16)
+      self._makeSubChunk(y // 16).setBlocks(x, y % 16, z, blocks[:, y - bottom:end - bottom], layer)
+      y = end
+
+  # Get a subchunk, creating empty ones as needed.
+  def _makeSubChunk(self, i):
+    while i + 1 > len(self.subchunks):
+      self.subchunks.append(SubChunk.empty(self.x, self.z, len(self.subchunks), self.dimension, self.keyBase))
+    if self.subchunks[i] is None:
+      self.subchunks[i] = SubChunk.empty(self.x, self.z, i, self.dimension, self.keyBase)
+    return self.subchunks[i]
+
+  # World x y z and NBT of the blocks that have any. Only walks those blocks, not the whole chunk.
+  def iterNbtBlocks(self):
+    if self._tileEntityData is not None:
+      self._loadTileEntities()
+    for subchunk in self.subchunks:
+      if subchunk is None:
+        continue
+      for (layer, x, y, z), nbtData in sorted(subchunk.nbt.items()):
+        if layer != 0: # Tile entities only apply to the main layer.
+          continue
+        y = subchunk.y * 16 + y
+        if self.cavesAndCliffs:
+          y -= 64
+        yield subchunk.x * 16 + x, y, subchunk.z * 16 + z, nbtData
+
+  # Only writes what changed. Subchunks track this themselves, the rest is compared against what is stored.
   def save(self, db):
-    version = struct.pack("<B", self.version)
-    ldb.put(db, self.keyBase + b",", version)
+    self._put(db, b",", struct.pack("<B", self.version))
     if not self.cavesAndCliffs:
       self._save2D(db)
     for subchunk in self.subchunks:
       if subchunk is None:
         continue
       subchunk.save(db)
-    self._saveTileEntities(db)
+    if self._tileEntityData is None: # Otherwise they were never even loaded.
+      self._saveTileEntities(db)
     self._saveEntities(db)
 
+  # Write one of the chunk's keys, unless it already holds this data. Missing keys count as empty.
+  def _put(self, db, key, data):
+    if self._stored.get(key, b"") != data:
+      ldb.put(db, self.keyBase + key, data)
+      self._stored[key] = data
+
   def _save2D(self, db):
-    data = struct.pack("<" + "H" * 16 * 16, *self.hMap)
-    data += struct.pack("B" * 16 * 16, *self.biomes)
-    ldb.put(db, self.keyBase + b'-', data)
+    data = np.asarray(self.hMap, dtype="<u2").tobytes() + np.asarray(self.biomes, dtype=np.uint8).tobytes()
+    self._put(db, b"-", data)
 
+  # Loaded tile entities are written back in their stored order with x y z where they were, so ones that did
+  #  not change encode to the same bytes and _put can skip them. New ones go at the end.
   def _saveTileEntities(self, db):
+    tileEntities = []
+    for x, y, z, nbtData in self.iterNbtBlocks():
+      order, layout = self._tileEntityLayout.get((x, y, z), (len(self._tileEntityLayout), None))
+      tileEntities.append((order, x, y, z, nbtData, layout))
+    tileEntities.sort(key=lambda tileEntity: tileEntity[0]) # Stable, new ones stay sorted by position.
     data = nbt.DataWriter()
-    for subchunk in self.subchunks:
-      if subchunk is None:
-        continue
-      for x in range(16):
-        for y in range(16):
-          for z in range(16):
-            block = subchunk.getBlock(x, y, z)
-            if block.nbt is not None: # Add back the correct position.
-              block.nbt.add(nbt.TAG_Int("x", subchunk.x * 16 + x))
-              block.nbt.add(nbt.TAG_Int("y", subchunk.y * 16 + y))
-              block.nbt.add(nbt.TAG_Int("z", subchunk.z * 16 + z))
-              nbt.encode(block.nbt, data)
-    ldb.put(db, self.keyBase + b"1", data.get())
+    for _, x, y, z, nbtData, layout in tileEntities:
+      # Add back the correct position, on a copy so it is not added again every save.
+      position = {"x": x, "y": y, "z": z}
+      payload = list(nbtData.payload)
+      if layout is None:
+        layout = [(len(payload), "x"), (len(payload) + 1, "y"), (len(payload) + 2, "z")]
+      for i, name in layout:
+        payload.insert(i, nbt.TAG_Int(name, position[name]))
+      nbt.encode(nbt.TAG_Compound(nbtData.name, payload), data)
+    self._put(db, b"1", data.get())
 
   def _saveEntities(self, db):
     data = nbt.DataWriter()
     for entity in self.entities:
       nbt.encode(entity, data)
-    ldb.put(db, self.keyBase + b"2", data.get())
+    self._put(db, b"2", data.get())
 
   def __repr__(self):
     return "Chunk {} {} (Dim {}): {} subchunks".format(self.x, self.z, self.dimension, len(self.subchunks))
 
 # Handles the blocks and block palette format.
 class SubChunk:
-  def __init__(self, db, x, z, y, dimension=0):
+  def __init__(self, db, x, z, y, dimension=0, keyBase=None, data=None):
     self.dirty = False
     self.x = x
     self.z = z
     self.y = y
     self.dimension = dimension
-    if db is not None: # For creating subchunks, there will be no DB.
-      # Subchunks are stored as base key + subchunk key `/` + subchunk id (y level // 16)
+    # Blocks are stored as per layer palettes of unique blocks, and arrays of ids pointing into them.
+    self.palettes = []
+    self.indices = []
+    self._paletteMaps = [] # Palette block (without nbt) to palette id, per layer
+    self.nbt = {} # (layer, x, y, z) to NBT for the few blocks that have any
+    # Subchunks are stored as base key + subchunk key `/` + subchunk id (y level // 16)
+    if keyBase is None: # Chunks pass theirs in so it is only packed once.
       if self.dimension == 0:
-        self.key = struct.pack("<iicB", x, z, b'/', y)
+        keyBase = struct.pack("<ii", x, z)
       else:
-        self.key = struct.pack("<iiicB", x, z, dimension, b'/', y)
-      try:
-        data = ldb.get(db, self.key)
-      except KeyError:
-        raise NotFoundError("Subchunk at {} {} (Dim {})/{} not found.".format(x, z, dimension, y))
-      self.version, data = data[0], data[1:]
+        keyBase = struct.pack("<iii", x, z, dimension)
+    self.key = keyBase + bytes((ord("/"), y))
+    self._raw = None # Undecoded subchunk data, see _load.
+    if db is not None: # For creating subchunks, there will be no DB.
+      if data is None: # Chunks pass in the data they already read.
+        try:
+          data = ldb.get(db, self.key)
+        except KeyError:
+          raise NotFoundError("Subchunk at {} {} (Dim {})/{} not found.".format(x, z, dimension, y))
+      self.version = data[0]
       if self.version not in [8, 9]:
         raise NotImplementedError("Unsupported subchunk version {} at {} {} (Dim {})/{}".format(self.version, x, z, dimension, y))
-      numStorages, data = data[0], data[1:]
+      self._raw = data
 
-      if self.version == 9:
-        self.y_db, data = data[0], data[1:]
+  # Decoding the blocks is by far the slowest part of loading, so it waits until they are first used.
+  def _load(self):
+    data, self._raw = self._raw[1:], None
+    numStorages, data = data[0], data[1:]
+
+    if self.version == 9:
+      self.y_db, data = data[0], data[1:]
+    else:
+      self.y_db = None
+
+    for i in range(numStorages):
+      blocks, data = self._loadBlocks(data)
+      if data:
+          palette, data = self._loadPalette(data)
+          self._addLayer([self._paletteBlock(block) for block in palette], blocks)
       else:
-        self.y_db = None
-
-      self.blocks = []
-      for i in range(numStorages):
-        blocks, data = self._loadBlocks(data)
-        if data:
-            palette, data = self._loadPalette(data)
-            self.blocks.append(np.empty(4096, dtype=Block)) # Prepare with correct dtype
-            for j, block in enumerate(blocks):
-              block = palette[block]
-              try: # 1.13 format
-                #if block["version"].payload != 17629200:
-                #  raise NotImplementedError("Unexpected block version {}".format(block["version"].payload))
-                self.blocks[i][j] = Block(block["name"].payload, block["states"].payload) # .payload to get actual val
-              except KeyError: # 1.12 format
-                self.blocks[i][j] = Block(block["name"].payload, block["val"].payload) # .payload to get actual val
-            self.blocks[i] = self.blocks[i].reshape(16, 16, 16).swapaxes(1, 2) # Y and Z saved in an inverted order
-        else:
-            # I *think* this means the whole subchunk is one type of block - commonly endstone
-            try: # 1.13 format
-                blocks = Block(blocks["name"].payload, blocks["states"].payload)
-            except KeyError: # 1.12 format
-                blocks = Block(blocks["name"].payload, blocks["val"].payload)
-            self.blocks.append(np.full(4096, blocks, dtype=Block))
-            self.blocks[i] = self.blocks[i].reshape(16, 16, 16)
+          # I *think* this means the whole subchunk is one type of block - commonly endstone
+          self._addLayer([self._paletteBlock(blocks)], np.zeros(4096, dtype=np.uint32))
 
   # These arent actual blocks, just ids pointing to the palette.
   def _loadBlocks(self, data):
@@ -285,15 +352,8 @@ class SubChunk:
     blocksPerWord = 32 // bitsPerBlock # Word = 4 bytes, basis of compacting.
     numWords = - (-4096 // blocksPerWord) # Ceiling divide is inverted floor divide
 
-    blockWords, data = struct.unpack("<" + "I" * numWords, data[:4 * numWords]), data[4 * numWords:]
-    blocks = np.empty(4096, dtype=np.uint32)
-    for i, word in enumerate(blockWords):
-      for j in range(blocksPerWord):
-        block = word & ((1 << bitsPerBlock) - 1) # Mask out number of bits for one block
-        word >>= bitsPerBlock # For next iteration
-        if i * blocksPerWord + j < 4096: # Safety net for padding at end.
-          blocks[i * blocksPerWord + j] = block
-    return blocks, data
+    words = np.frombuffer(data, dtype="<u4", count=numWords).astype(np.uint32, copy=False)
+    return _kernels.unpackBlocks(words, bitsPerBlock, 4096), data[4 * numWords:]
 
   # NBT encoded block names (with minecraft:) and data values.
   def _loadPalette(self, data):
@@ -305,35 +365,119 @@ class SubChunk:
       palette.append(block)
     return palette, data[dr.idx:]
 
+  # Palette entries are plain NBT, convert them to blocks.
+  @staticmethod
+  def _paletteBlock(block):
+    try: # 1.13 format
+      #if block["version"].payload != 17629200:
+      #  raise NotImplementedError("Unexpected block version {}".format(block["version"].payload))
+      return Block(block["name"].payload, block["states"].payload) # .payload to get actual val
+    except KeyError: # 1.12 format
+      return Block(block["name"].payload, block["val"].payload) # .payload to get actual val
+
+  # Add a layer from a palette of blocks and the ids pointing into it. Duplicate palette entries get merged.
+  def _addLayer(self, palette, blockIDs):
+    self.palettes.append([])
+    self._paletteMaps.append({})
+    layer = len(self.palettes) - 1
+    remap = np.array([self._paletteIndex(layer, block, False) for block in palette], dtype=np.uint16)
+    self.indices.append(remap[blockIDs].reshape(16, 16, 16).swapaxes(1, 2)) # Y and Z saved in an inverted order
+
+  # Get the palette id of a block, adding it to the palette if needed. NBT is stored separately.
+  #  Blocks that are not the caller's own, like freshly loaded ones, can skip being copied.
+  def _paletteIndex(self, layer, block, copy=True):
+    if block.nbt is not None: # Palette entries are blocks without nbt.
+      block = Block(block.name, block.properties)
+    idx = self._paletteMaps[layer].get(block)
+    if idx is None:
+      if len(self.palettes[layer]) > 0xffff: # Ids are uint16, make room first.
+        self._compactPalette(layer)
+      # Our own copy down to the state tags, so changing the caller's block can't change the key.
+      #  An encode and decode round trip copies any kind of tag, and only happens for new palette entries.
+      properties = block.properties
+      if copy and isinstance(properties, list):
+        properties = [nbt.decode(nbt.DataReader(nbt.encode(tag))) for tag in properties]
+      block = Block(block.name, properties)
+      idx = self._paletteMaps[layer][block] = len(self.palettes[layer])
+      self.palettes[layer].append(block)
+    return idx
+
+  # Drop palette entries no block uses anymore. The palette only grows otherwise, and could overflow uint16.
+  def _compactPalette(self, layer):
+    indices = self.indices[layer]
+    used = np.flatnonzero(np.bincount(indices.reshape(4096), minlength=len(self.palettes[layer])))
+    remap = np.zeros(len(self.palettes[layer]), dtype=np.uint16)
+    remap[used] = np.arange(len(used), dtype=np.uint16)
+    indices[...] = remap[indices] # In place, indices is a view.
+    self.palettes[layer] = [self.palettes[layer][i] for i in used]
+    self._paletteMaps[layer] = {block: i for i, block in enumerate(self.palettes[layer])}
+
   def getBlock(self, x, y, z, layer=0):
-    if layer >= len(self.blocks):
+    if self._raw is not None:
+      self._load()
+    if layer >= len(self.indices):
       raise KeyError("Subchunk {} {} (Dim {})/{} does not have a layer {}".format(self.x, self.z, self.dimension, self.y, layer))
-    return self.blocks[layer][x, y, z]
+    block = self.palettes[layer][self.indices[layer][x, y, z]]
+    return Block(block.name, block.properties, self.nbt.get((layer, x, y, z)))
 
   def setBlock(self, x, y, z, block, layer=0):
-    if layer >= len(self.blocks):
+    if self._raw is not None:
+      self._load()
+    if layer >= len(self.indices):
       raise KeyError("Subchunk {} {} (Dim {})/{} does not have a layer {}".format(self.x, self.z, self.dimension, self.y, layer))
-    self.blocks[layer][x, y, z] = block
+    self.indices[layer][x, y, z] = self._paletteIndex(layer, block)
+    if block.nbt is not None:
+      self.nbt[(layer, x, y, z)] = block.nbt
+    else:
+      self.nbt.pop((layer, x, y, z), None)
+    self.dirty = True
+
+  # Set a box of blocks with its lowest corner at x y z, see World.setBlocks.
+  def setBlocks(self, x, y, z, blocks, layer=0):
+    if self._raw is not None:
+      self._load()
+    if layer >= len(self.indices):
+      raise KeyError("Subchunk {} {} (Dim {})/{} does not have a layer {}".format(self.x, self.z, self.dimension, self.y, layer))
+    sizeX, sizeY, sizeZ = blocks.shape
+    if len(self.palettes[layer]) + blocks.size > 0x10000: # Compact up front, ids handed out below must stay valid.
+      self._compactPalette(layer)
+    for key in [key for key in self.nbt if key[0] == layer and x <= key[1] < x + sizeX and y <= key[2] < y + sizeY and z <= key[3] < z + sizeZ]:
+      del self.nbt[key]
+    ids = np.empty(blocks.shape, dtype=np.uint16)
+    known = {} # The same Block object is usually reused, skip interning it again.
+    for (i, j, k), block in np.ndenumerate(blocks):
+      idx = known.get(id(block))
+      if idx is None:
+        idx = known[id(block)] = self._paletteIndex(layer, block)
+      ids[i, j, k] = idx
+      if block.nbt is not None:
+        self.nbt[(layer, x + i, y + j, z + k)] = block.nbt
+    self.indices[layer][x:x + sizeX, y:y + sizeY, z:z + sizeZ] = ids
     self.dirty = True
 
   def save(self, db, force=False):
     if self.dirty or force:
-      data = struct.pack("<BB", self.version, len(self.blocks))
-      for i in range(len(self.blocks)):
+      if self._raw is not None:
+        self._load()
+      # Collect the pieces and join once at the end, bytes concatenation would copy everything each time.
+      data = [struct.pack("<BB", self.version, len(self.indices))]
+      if self.version == 9:
+        data.append(struct.pack("B", self.y_db))
+      for i in range(len(self.indices)):
         palette, blockIDs = self._savePalette(i)
-        data += self._saveBlocks(len(palette), blockIDs)
-        data += struct.pack("<I", len(palette))
+        data.append(self._saveBlocks(len(palette), blockIDs))
+        data.append(struct.pack("<I", len(palette)))
+        paletteData = nbt.DataWriter()
         for block in palette:
-          data += nbt.encode(block)
+          nbt.encode(block, paletteData)
+        data.append(paletteData.get())
 
-      if self.version == 9:
-        data = struct.pack("B", self.y_db) + data
-
-      ldb.put(db, self.key, data)
+      ldb.put(db, self.key, b"".join(data))
+      self.dirty = False
 
   # Compact blockIDs bitwise. See _loadBlocks for details.
   def _saveBlocks(self, paletteSize, blockIDs):
-    bitsPerBlock = max(int(np.ceil(np.log2(paletteSize))), 1)
+    bitsPerBlock = max((paletteSize - 1).bit_length(), 1) # Exact ceil(log2(paletteSize)) on ints.
     for bits in [1, 2, 3, 4, 5, 6, 8, 16]:
       if bits >= bitsPerBlock:
         bitsPerBlock = bits
@@ -342,44 +486,36 @@ class SubChunk:
       raise NotImplementedError("Too many bits per block needed {} at {} {} (Dim {})/{}".format(bitsPerBlock, self.x, self.z, self.dimension, self.y))
     blocksPerWord = 32 // bitsPerBlock
     numWords = - (-4096 // blocksPerWord)
-    data = struct.pack("<B", bitsPerBlock << 1)
-
-    for i in range(numWords):
-      word = 0
-      for j in range(blocksPerWord - 1, -1, -1):
-        if i * blocksPerWord + j < 4096:
-          word <<= bitsPerBlock
-          word |= blockIDs[i * blocksPerWord + j]
-      data += struct.pack("<I", word)
-    return data
-
-  # Make a palette, and get the block ids at the same time
+
+    words = _kernels.packBlocks(blockIDs, bitsPerBlock, numWords)
+    return struct.pack("<B", bitsPerBlock << 1) + words.astype("<u4").tobytes()
+
+  # Make a palette of the blocks in use, and get the block ids at the same time
   def _savePalette(self, layer):
-    blocks = self.blocks[layer].swapaxes(1, 2).reshape(4096) # Y and Z saved in a inverted order
-    blockIDs = np.empty(4096, dtype=np.uint32)
+    blocks = self.indices[layer].swapaxes(1, 2).reshape(4096) # Y and Z saved in a inverted order
+    # Drop unused palette entries and renumber the rest, in one linear pass.
+    used = np.flatnonzero(np.bincount(blocks, minlength=len(self.palettes[layer])))
+    remap = np.zeros(len(self.palettes[layer]), dtype=np.uint32)
+    remap[used] = np.arange(len(used), dtype=np.uint32)
+    blockIDs = remap[blocks]
     palette = []
-    mapping = {}
-    for i, block in enumerate(blocks):
+    for block in (self.palettes[layer][i] for i in used):
       # Generate the palette nbt for the given block
-      short = (block.name, str(block.properties))
-      if short not in mapping:
-        if isinstance(block.properties, int): # 1.12
-          palette.append(nbt.TAG_Compound("", [nbt.TAG_String("name", block.name), nbt.TAG_Short("val", block.properties)]))
-        else: # 1.13
-          palette.append(nbt.TAG_Compound("", [
-            nbt.TAG_String("name", block.name),
-            nbt.TAG_Compound("states", block.properties),
-            nbt.TAG_Int("version", 17629200)
-          ]))
-        mapping[short] = len(palette) - 1
-      blockIDs[i] = mapping[short]
+      if isinstance(block.properties, int): # 1.12
+        palette.append(nbt.TAG_Compound("", [nbt.TAG_String("name", block.name), nbt.TAG_Short("val", block.properties)]))
+      else: # 1.13
+        palette.append(nbt.TAG_Compound("", [
+          nbt.TAG_String("name", block.name),
+          nbt.TAG_Compound("states", block.properties),
+          nbt.TAG_Int("version", 17629200)
+        ]))
     return palette, blockIDs
 
   @classmethod
-  def empty(cls, x, z, y, dimension=0):
-    subchunk = cls(None, x, z, y, dimension)
+  def empty(cls, x, z, y, dimension=0, keyBase=None):
+    subchunk = cls(None, x, z, y, dimension, keyBase)
     subchunk.version = 8
-    subchunk.blocks = [np.full((16, 16, 16), Block("minecraft:air"), dtype=Block)]
+    subchunk._addLayer([Block("minecraft:air")], np.zeros(4096, dtype=np.uint32))
     return subchunk
 
 # Generic block storage.
@@ -398,8 +534,9 @@ class Block:
   def __repr__(self):
     return "{} {}".format(self.name, self.properties)
 
+  # Leaves out nbt, which is stored separately from the palette. Blocks that are equal still hash the same.
   def __hash__(self):
-    return self.__repr__().__hash__()
+    return hash((self.name, str(self.properties)))
 
 # Handles NBT generation for command blocks.
 class CommandBlock(Block):
@@ -410,30 +547,34 @@ class CommandBlock(Block):
     dv = self.dMap[d]
     if cond:
       dv += 8
-    nbtData = nbt.TAG_Compound("", [])
-    nbtData.add(nbt.TAG_Byte("auto", int(not redstone)))
-    nbtData.add(nbt.TAG_String("Command", cmd))
-    nbtData.add(nbt.TAG_String("CustomName", hover))
-    nbtData.add(nbt.TAG_Byte("powered", int(block == "R" and not redstone)))
+    # Build the tags as one list and hand it to the compound, instead of adding them one at a time.
+    nbtData = [
+      nbt.TAG_Byte("auto", int(not redstone)),
+      nbt.TAG_String("Command", cmd),
+      nbt.TAG_String("CustomName", hover),
+      nbt.TAG_Byte("powered", int(block == "R" and not redstone))
+    ]
     if time == 0 and not first:
-      nbtData.add(nbt.TAG_Int("Version", 8))
+      nbtData.append(nbt.TAG_Int("Version", 8))
     else:
-      nbtData.add(nbt.TAG_Int("Version", 9))
-      nbtData.add(nbt.TAG_Byte("ExecuteOnFirstTick", int(first)))
-      nbtData.add(nbt.TAG_Int("TickDelay", time))
-
-    nbtData.add(nbt.TAG_Byte("conditionMet", 0))
-    nbtData.add(nbt.TAG_String("id", "CommandBlock"))
-    nbtData.add(nbt.TAG_Byte("isMovable", 1))
-    nbtData.add(nbt.TAG_Int("LPCommandMode", 0)) # Not sure what these LPModes do. This works.
-    nbtData.add(nbt.TAG_Byte("LPConditionalMode", 0))
-    nbtData.add(nbt.TAG_Byte("LPRedstoneMode", 0))
-    nbtData.add(nbt.TAG_Long("LastExecution", 0))
-    nbtData.add(nbt.TAG_String("LastOutput", ""))
-    nbtData.add(nbt.TAG_List("LastOutputParams", []))
-    nbtData.add(nbt.TAG_Int("SuccessCount", 0))
-    nbtData.add(nbt.TAG_Byte("TrackOutput", 1))
-    super().__init__(name, dv, nbtData)
+      nbtData.append(nbt.TAG_Int("Version", 9))
+      nbtData.append(nbt.TAG_Byte("ExecuteOnFirstTick", int(first)))
+      nbtData.append(nbt.TAG_Int("TickDelay", time))
+
+    nbtData += [
+      nbt.TAG_Byte("conditionMet", 0),
+      nbt.TAG_String("id", "CommandBlock"),
+      nbt.TAG_Byte("isMovable", 1),
+      nbt.TAG_Int("LPCommandMode", 0), # Not sure what these LPModes do. This works.
+      nbt.TAG_Byte("LPConditionalMode", 0),
+      nbt.TAG_Byte("LPRedstoneMode", 0),
+      nbt.TAG_Long("LastExecution", 0),
+      nbt.TAG_String("LastOutput", ""),
+      nbt.TAG_List("LastOutputParams", []),
+      nbt.TAG_Int("SuccessCount", 0),
+      nbt.TAG_Byte("TrackOutput", 1)
+    ]
+    super().__init__(name, dv, nbt.TAG_Compound("", nbtData))
 
 class NotFoundError(Exception):
   pass
@@ -1,6 +1,16 @@
 # A simple and flexible NBT parser.
 
 import struct
+import numpy as np
+
+# Compiled little endian formats by key, so each format string is only parsed once.
+_structs = {}
+
+def _getStruct(key):
+  compiled = _structs.get(key)
+  if compiled is None:
+    compiled = _structs[key] = struct.Struct("<{}".format(key))
+  return compiled
 
 # Allows for easy sequential reading of binary data
 class DataReader:
@@ -9,16 +19,15 @@ class DataReader:
     self.idx = 0
 
   def pop(self, key):
-    key = "<{}".format(key)
-    size = struct.calcsize(key)
-    popped = struct.unpack(key, self.data[self.idx:self.idx + size])[0]
-    self.idx += size
+    compiled = _getStruct(key)
+    popped = compiled.unpack_from(self.data, self.idx)[0]
+    self.idx += compiled.size
     return popped
 
   # Specific to the NBT string format, two bytes for size followed by that many bytes of string.
   def popString(self):
     size = self.pop("h")
-    popped = struct.unpack("<{}s".format(size), self.data[self.idx:self.idx + size])[0]
+    popped = self.data[self.idx:self.idx + size]
     self.idx += size
     try:
       popped = popped.decode("utf-8")
@@ -39,14 +48,17 @@ class DataWriter:
     self.data = []
 
   def put(self, key, *data):
-    key = "<{}".format(key)
-    self.data.append(struct.pack(key, *data))
+    self.data.append(_getStruct(key).pack(*data))
+
+  # Raw bytes, for array payloads.
+  def putBytes(self, data):
+    self.data.append(data)
 
   def putString(self, string):
     if not isinstance(string, bytes):
       string = string.encode("utf-8")
     self.put("h", len(string))
-    self.data.append(struct.pack("<{}s".format(len(string)), string))
+    self.data.append(string)
 
   def get(self):
     return b"".join(self.data)
@@ -56,6 +68,7 @@ class DataWriter:
 
 # Generic base tag, calls self.decode with binary data to fill in payload.
 class TAG:
+  __slots__ = ("name", "payload") # There are a lot of tags, keep them small. ID stays on the class.
   ID = None
   def __init__(self, name, data):
     self.name = name
@@ -90,7 +103,7 @@ def TAG_Generator(ID, fmt, name):
     return dataReader.pop(fmt)
   def _encode(self, dataWriter):
     return dataWriter.put(fmt, self.payload)
-  return type("TAG_{}".format(name), (TAG,), {"ID": ID, "decode": _decode, "encode": _encode})
+  return type("TAG_{}".format(name), (TAG,), {"__slots__": (), "ID": ID, "fmt": fmt, "decode": _decode, "encode": _encode})
 
 tags = [] # Need to pre define tags for the later classes.
 
@@ -101,22 +114,40 @@ TAG_Long = TAG_Generator(4, "q", "Long")
 TAG_Float = TAG_Generator(5, "f", "Float")
 TAG_Double = TAG_Generator(6, "d", "Double")
 
-# Similar to TAG_List, except the type of tag is not specified, as we know it is a byte.
+# A length followed by that many bytes. The payload is a numpy array of the values (or anything convertible to one).
 class TAG_Byte_Array(TAG):
+  __slots__ = ()
   ID = 7
+  def __init__(self, name, data):
+    super().__init__(name, data)
+    self.payload = self._values(self.payload)
+
+  # Lists of TAG_Bytes, the old payload, are still accepted.
+  @staticmethod
+  def _values(payload):
+    if isinstance(payload, list):
+      payload = [item.payload if isinstance(item, TAG) else item for item in payload]
+    return np.asarray(payload, dtype=np.uint8)
+
   def decode(self, dataReader):
     size = dataReader.pop("i")
-    payload = []
-    for i in range(size):
-      payload.append(TAG_Byte(i, dataReader))
+    payload = np.frombuffer(dataReader.data, dtype=np.uint8, count=size, offset=dataReader.idx).copy() # Copy so it is writable.
+    dataReader.idx += size
     return payload
 
   def encode(self, dataWriter):
-    dataWriter.put("i", len(self.payload)) # Size
-    for item in self.payload:
-      item.encode(dataWriter)
+    payload = self._values(self.payload) # In case payload was replaced since.
+    dataWriter.put("i", len(payload)) # Size
+    dataWriter.putBytes(payload.tobytes())
+
+  def __getitem__(self, idx):
+    return self.payload[idx]
+
+  def __eq__(self, other):
+    return self.name == other.name and self.ID == other.ID and np.array_equal(self.payload, other.payload)
 
 class TAG_String(TAG):
+  __slots__ = ()
   ID = 8
   def decode(self, dataReader):
     return dataReader.popString()
@@ -126,39 +157,49 @@ class TAG_String(TAG):
 # Basically a TAG_Compound, but the items don't have names, and instead are named integer indexes.
 #  This allows for a generic __getitem__ function in the TAG class.
 class TAG_List(TAG):
+  __slots__ = ("itemID",)
   ID = 9
+  def __init__(self, name, data):
+    self.itemID = 0 # TAG_End, for an empty list of unknown type.
+    super().__init__(name, data)
+    if self.payload:
+      self.itemID = self.payload[0].ID
+
   def decode(self, dataReader):
     self.itemID = dataReader.pop("b")
     size = dataReader.pop("i")
-    payload = []
-    for i in range(size):
-      payload.append(tags[self.itemID](i, dataReader))
-    return payload
+    decodeItem = _decoders[self.itemID]
+    return [decodeItem(dataReader, i) for i in range(size)]
 
   def encode(self, dataWriter):
-    if self.payload == []: # We don't know the dataWriter type.
-      dataWriter.put("b", 0) # Default to TAG_End
-    else:
-      dataWriter.put("b", tags.index(type(self.payload[0])))
+    if self.payload:
+      dataWriter.put("b", self.payload[0].ID)
+    else: # Empty lists keep the type they were read or created with.
+      dataWriter.put("b", self.itemID)
     dataWriter.put("i", len(self.payload))
     for item in self.payload:
       item.encode(dataWriter)
 
   def add(self, tag):
     self.payload.append(tag)
+    self.itemID = tag.ID
 
 # Stores some number of complete tags, followed by a TAG_End
 class TAG_Compound(TAG):
+  __slots__ = ("_index", "_indexed") # Name to payload position built on first lookup, and the payload length it was built for.
   ID = 10
+  def __init__(self, name, data):
+    self._index = None
+    self._indexed = -1
+    super().__init__(name, data)
+
   def decode(self, dataReader):
+    self._index = None # Decoded tags skip __init__.
+    self._indexed = -1
     payload = []
     tagID = dataReader.pop("b")
     while tagID != 0:
-      if tags[tagID] is not None:
-        name = dataReader.popString()
-        payload.append(tags[tagID](name, dataReader))
-      else:
-        raise NotImplementedError("Tag {} not implemented.".format(tagID))
+      payload.append(_decoders[tagID](dataReader, dataReader.popString()))
       tagID = dataReader.pop("b")
     return payload
 
@@ -171,13 +212,58 @@ class TAG_Compound(TAG):
 
   def add(self, tag):
     self.payload.append(tag)
+    if self._indexed == len(self.payload) - 1:
+      self._index.setdefault(tag.name, self._indexed)
+      self._indexed += 1
 
   def pop(self, name):
-    for i in range(len(self.payload)):
-      if self.payload[i].name == name:
-        return self.payload.pop(i)
-    return None
+    payload = self.payload
+    if self._indexed != len(payload): # Not indexed, one scan is cheaper than building the index.
+      self._indexed = -1
+      for i in range(len(payload)):
+        if payload[i].name == name:
+          return payload.pop(i)
+      return None
+    i = self._find(name)
+    if i is None:
+      return None
+    index = self._index
+    if len(index) == self._indexed: # No duplicate names, so just move the items after i down one.
+      del index[name]
+      for j in range(i + 1, len(payload)):
+        index[payload[j].name] = j - 1
+      self._indexed -= 1
+    else: # A later item with the same name takes its place, simplest to rebuild.
+      self._indexed = -1
+    return payload.pop(i)
+
+  # Position of the first item with the given name, or None.
+  def _find(self, name):
+    payload = self.payload
+    if self._indexed == len(payload):
+      i = self._index.get(name)
+      if i is not None and i < len(payload) and payload[i].name == name:
+        return i
+      # The payload may have been changed directly, so check a miss with a scan. Only rebuild if it is there.
+      for item in payload:
+        if item.name == name:
+          break
+      else:
+        return None
+    # Not indexed yet, or the payload was changed directly. Rebuild and try again.
+    self._index = index = {}
+    for i, item in enumerate(payload):
+      index.setdefault(item.name, i)
+    self._indexed = len(payload)
+    return index.get(name)
+
+  def __getitem__(self, name):
+    i = self._find(name)
+    if i is None:
+      raise KeyError("{} not found in {}".format(name, self.payload))
+    return self.payload[i]
 
+  # A scan is as fast as the index for the small compounds this is used on, and needs no checks.
   def __contains__(self, name):
     for item in self.payload:
       if item.name == name:
@@ -186,13 +272,12 @@ class TAG_Compound(TAG):
 
 # Similar to TAG_List, except the type of tag is not specified, as we know it is an int.
 class TAG_Int_Array(TAG):
-  ID = 7
+  __slots__ = ()
+  ID = 11
   def decode(self, dataReader):
     size = dataReader.pop("i")
-    payload = []
-    for i in range(size):
-      payload.append(TAG_Int(i, dataReader))
-    return payload
+    decodeItem = _decoders[TAG_Int.ID]
+    return [decodeItem(dataReader, i) for i in range(size)]
 
   def encode(self, dataWriter):
     dataWriter.put("i", len(self.payload)) # Size
@@ -201,13 +286,12 @@ class TAG_Int_Array(TAG):
 
 # Similar to TAG_List, except the type of tag is not specified, as we know it is a long.
 class TAG_Long_Array(TAG):
-  ID = 7
+  __slots__ = ()
+  ID = 12
   def decode(self, dataReader):
     size = dataReader.pop("i")
-    payload = []
-    for i in range(size):
-      payload.append(TAG_Long(i, dataReader))
-    return payload
+    decodeItem = _decoders[TAG_Long.ID]
+    return [decodeItem(dataReader, i) for i in range(size)]
 
   def encode(self, dataWriter):
     dataWriter.put("i", len(self.payload)) # Size
@@ -228,12 +312,39 @@ tags = [None,
         TAG_Int_Array,
         TAG_Long_Array]
 
+# Builds a function that reads a tag straight from a DataReader, skipping TAG.__init__ and its isinstance check.
+def _decoder(tagClass):
+  if hasattr(tagClass, "fmt"): # Simple tags, unpack the value inline.
+    compiled = _getStruct(tagClass.fmt)
+    def _decode(dataReader, name):
+      tag = object.__new__(tagClass)
+      tag.name = name
+      tag.payload = compiled.unpack_from(dataReader.data, dataReader.idx)[0]
+      dataReader.idx += compiled.size
+      return tag
+  else:
+    def _decode(dataReader, name):
+      tag = object.__new__(tagClass)
+      tag.name = name
+      tag.payload = tag.decode(dataReader)
+      return tag
+  return _decode
+
+# Stands in for tags we can't decode, so the decode loops don't have to check for them.
+def _unimplemented(tagID):
+  def _decode(dataReader, name):
+    raise NotImplementedError("Tag {} not implemented.".format(tagID))
+  return _decode
+
+# Decode functions indexed by tag ID, covering every possible ID byte.
+_decoders = [_unimplemented(tagID) for tagID in range(256)]
+for tagID, tag in enumerate(tags):
+  if tag is not None:
+    _decoders[tagID] = _decoder(tag)
+
 def decode(dataReader):
   tagID = dataReader.pop("b")
-  if tags[tagID] is not None:
-    name = dataReader.popString()
-    return tags[tagID](name, dataReader)
-  raise NotImplementedError("Tag {} not implemented.".format(tagID))
+  return _decoders[tagID](dataReader, dataReader.popString())
 
 def encode(toEncode, dataWriter=None):
   new = not dataWriter
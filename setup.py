@@ -7,6 +7,7 @@ setup(name="bedrock",
       url="https://github.com/BluCodeGH/bedrock",
       packages=["bedrock"],
       install_requires=["numpy"],
+      extras_require={"numba": ["numba"]},
       package_data={
           "bedrock": ["*.dll", "*.so", "LICENCE-LEVELDB"]
       },